@@ -1,13 +1,35 @@
 import re
 import os
 import json
+import logging
 import jose
 import time
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict, namedtuple
 from http import HTTPStatus
-from jose import jwk, jwt
+from jose import jwk
 from jose.utils import base64url_decode
 
+logger = logging.getLogger(__name__)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+# JWKS of each user pool as {kid: jwk}, keyed by keys_url. Kept across warm invocations.
+_JWKS_CACHE = {}
+# time.monotonic() of the last JWKS fetch, keyed by keys_url. A kid miss refetches at most once per interval.
+_JWKS_FETCHED_AT = {}
+_JWKS_REFETCH_INTERVAL = 60
+# Public keys constructed from the JWKS, keyed by (keys_url, kid). Keys gone from a refetched JWKS are dropped.
+_PUBKEY_CACHE = {}
+# (int exp, aud) of tokens with a verified signature, keyed by sha256 of the token. Least recently used first.
+_VERIFIED = OrderedDict()
+_VERIFIED_MAX = 1024
+
+# Keep-alive session so refetching the JWKS reuses the TLS connection.
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
 
 def lambda_handler(event, context):
     region = os.environ['AWS_DEFAULT_REGION']
@@ -16,7 +38,7 @@ def lambda_handler(event, context):
     account_id = event['requestContext']['accountId']
     api_id = event['requestContext']['apiId']
     stage = event['requestContext']['stage']
-    print(f'region:{region}, account_id:{account_id}, api_id:{api_id}, stage:{stage}, user_pool_id:{user_pool_id}')
+    logger.debug('region:%s, account_id:%s, api_id:%s, stage:%s, user_pool_id:%s', region, account_id, api_id, stage, user_pool_id)
 
     policy = AuthPolicy('', account_id)
     policy.region = region
@@ -32,48 +54,39 @@ def lambda_handler(event, context):
         # Allow user to call APIGateway.
         policy.allowAllMethods()
         response = policy.build()
-        print(response)
+        logger.debug('%s', response)
         return response
     except InvalidTokenError as e:
         policy.denyAllMethods()
         response = policy.build()
         response['context'] = {'message': e}
-        print(response)
+        logger.debug('%s', response)
         return response
     except Exception as e:
         raise e
 
 
 def validate_token(token: str, region: str, user_pool_id: str, client_id: str, user_agent: str):
-    # Validate whether to match local public key and remote one.
-    keys_url = f'https://cognito-idp.{region}.amazonaws.com/{user_pool_id}/.well-known/jwks.json'
-    headers = jwt.get_unverified_headers(token)
-    print(f'token:{token}')
-
-    response = requests.get(keys_url)
-    keys = json.loads(response.text)['keys']
-    target_key = None
-    for key in keys:
-        if key['kid'] == headers['kid']:
-            target_key = key
-    if target_key is None:
-        raise InvalidTokenError('Invalid public key in headers.')
+    # Validate UserAgent in header. This is allowed cognito-authorizer only.
+    if user_agent != 'cognito-authorizer':
+        raise InvalidTokenError('Invalid UserAgent.')
 
-    # Validate signature of JWT.
-    public_key = jwk.construct(target_key)
-    print(f'public_key:{public_key}')
-    message = token.rsplit('.', 1)[0].encode('utf-8')  # message = header + payload
-    signature = token.rsplit('.', 1)[1].encode('utf-8')
-    decode_signature = base64url_decode(signature)
-    print(f'message:{message}')
-    print(f'signature:{signature}')
-    print(f'decode_signature:{decode_signature}')
-
-    if not public_key.verify(message, decode_signature):
-        raise InvalidTokenError('Invalid token signature.')
+    # Tokens whose signature was already verified skip the JWKS lookup and RSA verify.
+    token_hash = hashlib.sha256(token.encode('utf-8')).digest()
+    verified = _VERIFIED.get(token_hash)
+    if verified is not None and int(time.time()) < verified[0]:
+        _VERIFIED.move_to_end(token_hash)
+        if verified[1] != client_id:
+            raise InvalidTokenError('Invalid aud(Cognito Client ID).')
+        return
+    _VERIFIED.pop(token_hash, None)
+
+    # Check the claims before the signature, which is the expensive part. A well-formed token
+    # with an unknown kid still reaches the JWKS lookup, where refetches are rate limited.
+    jwt_parts = _split_jwt(token)
+    claims = jwt_parts.claims
 
     # Validate expire of JWT.
-    claims = jwt.get_unverified_claims(token)
     if time.time() > claims['exp']:
         raise InvalidTokenError('Token is expired.')
 
@@ -81,15 +94,86 @@ def validate_token(token: str, region: str, user_pool_id: str, client_id: str, u
     if claims['aud'] != client_id:
         raise InvalidTokenError('Invalid aud(Cognito Client ID).')
 
-    # Validate UserAgent in header. This is allowed cognito-authorizer only.
-    if user_agent != 'cognito-authorizer':
-        raise InvalidTokenError('Invalid UserAgent.')
+    _verify_signature(jwt_parts, region, user_pool_id)
+
+    _VERIFIED[token_hash] = (int(claims['exp']), claims['aud'])
+    if len(_VERIFIED) > _VERIFIED_MAX:
+        _VERIFIED.popitem(last=False)
+
+
+def _split_jwt(token: str):
+    '''Splits the JWT into its segments and decodes the header and claims once.'''
+    try:
+        header_b64, claims_b64, signature_b64 = token.split('.')
+        headers = json.loads(base64url_decode(header_b64.encode('utf-8')))
+        claims = json.loads(base64url_decode(claims_b64.encode('utf-8')))
+    except ValueError:
+        raise InvalidTokenError('Invalid token format.')
+    if (not isinstance(headers, dict) or not isinstance(headers.get('kid'), str) or
+            not isinstance(claims, dict) or 'aud' not in claims or
+            not isinstance(claims.get('exp'), (int, float)) or isinstance(claims['exp'], bool)):
+        raise InvalidTokenError('Invalid token format.')
+    message = f'{header_b64}.{claims_b64}'.encode('utf-8')  # message = header + payload
+    signature = signature_b64.encode('utf-8')
+    return JwtParts(headers, claims, message, signature)
+
+
+def _verify_signature(jwt_parts, region: str, user_pool_id: str):
+    '''Verifies the signature of the JWT with the public key of the user pool.'''
+    # Validate whether to match local public key and remote one.
+    keys_url = f'https://cognito-idp.{region}.amazonaws.com/{user_pool_id}/.well-known/jwks.json'
+    kid = jwt_parts.headers['kid']
+    target_key = _get_key(kid, keys_url)
+    if target_key is None:
+        raise InvalidTokenError('Invalid public key in headers.')
+
+    # Validate signature of JWT.
+    public_key = _PUBKEY_CACHE.get((keys_url, kid))
+    if public_key is None:
+        public_key = jwk.construct(target_key)
+        _PUBKEY_CACHE[(keys_url, kid)] = public_key
+    logger.debug('public_key:%s', public_key)
+    decode_signature = base64url_decode(jwt_parts.signature)
+    logger.debug('message:%s', jwt_parts.message)
+    logger.debug('signature:%s', jwt_parts.signature)
+    logger.debug('decode_signature:%s', decode_signature)
+
+    if not public_key.verify(jwt_parts.message, decode_signature):
+        raise InvalidTokenError('Invalid token signature.')
+
+
+def _get_key(kid: str, keys_url: str):
+    '''Returns the JWK matching kid. The JWKS is fetched on first use and fetched
+    again when kid is not found, to pick up rotated keys. The refetch happens at most
+    once per _JWKS_REFETCH_INTERVAL seconds so unknown kids cannot force a fetch per request.'''
+    # kid comes from the unsigned header; anything but a string cannot be a dict key here.
+    if not isinstance(kid, str):
+        return None
+
+    keys = _JWKS_CACHE.get(keys_url)
+    if keys is not None:
+        if kid in keys:
+            return keys[kid]
+        if time.monotonic() - _JWKS_FETCHED_AT[keys_url] < _JWKS_REFETCH_INTERVAL:
+            return None
+
+    response = _SESSION.get(keys_url, timeout=(1, 2))
+    keys = {key['kid']: key for key in json.loads(response.text)['keys']}
+    _JWKS_CACHE[keys_url] = keys
+    _JWKS_FETCHED_AT[keys_url] = time.monotonic()
+    stale = [k for k in _PUBKEY_CACHE if k[0] == keys_url and k[1] not in keys]
+    for k in stale:
+        del _PUBKEY_CACHE[k]
+    return keys.get(kid)
 
 
 class InvalidTokenError(Exception):
     pass
 
 
+JwtParts = namedtuple('JwtParts', ['headers', 'claims', 'message', 'signature'])
+
+
 class HttpVerb:
     GET = 'GET'
     POST = 'POST'
@@ -101,35 +185,35 @@ class HttpVerb:
     ALL = '*'
 
 
+_VERBS = frozenset({
+    HttpVerb.GET, HttpVerb.POST, HttpVerb.PUT, HttpVerb.PATCH,
+    HttpVerb.HEAD, HttpVerb.DELETE, HttpVerb.OPTIONS, HttpVerb.ALL
+})
+
+
 class AuthPolicy(object):
-    # The AWS account id the policy will be generated for. This is used to create the method ARNs.
-    awsAccountId = ''
-    # The principal used for the policy, this should be a unique identifier for the end user.
-    principalId = ''
+    __slots__ = ('awsAccountId', 'principalId', 'region', 'stage', 'restApiId', 'allowMethods', 'denyMethods')
+
     # The policy version used for the evaluation. This should always be '2012-10-17'
     version = '2012-10-17'
     # The regular expression used to validate resource paths for the policy
-    pathRegex = '^[/.a-zA-Z0-9-\*]+$'
-
-    '''Internal lists of allowed and denied methods.
-
-    These are lists of objects and each object has 2 properties: A resource
-    ARN and a nullable conditions statement. The build method processes these
-    lists and generates the approriate statements for the final policy.
-    '''
-    allowMethods = []
-    denyMethods = []
-
-    # The API Gateway API id. By default this is set to '*'
-    restApiId = '*'
-    # The region where the API is deployed. By default this is set to '*'
-    region = '*'
-    # The name of the stage used in the policy. By default this is set to '*'
-    stage = '*'
+    _PATH_RE = re.compile(r'^[/.a-zA-Z0-9-\*]+$')
 
     def __init__(self, principal, awsAccountId):
+        # The AWS account id the policy will be generated for. This is used to create the method ARNs.
         self.awsAccountId = awsAccountId
+        # The principal used for the policy, this should be a unique identifier for the end user.
         self.principalId = principal
+        # The region where the API is deployed. By default this is set to '*'
+        self.region = '*'
+        # The name of the stage used in the policy. By default this is set to '*'
+        self.stage = '*'
+        # The API Gateway API id. By default this is set to '*'
+        self.restApiId = '*'
+
+        # Internal lists of allowed and denied methods. These are lists of objects and each
+        # object has 2 properties: A resource ARN and a nullable conditions statement. The build
+        # method processes these lists and generates the approriate statements for the final policy.
         self.allowMethods = []
         self.denyMethods = []
 
@@ -137,16 +221,15 @@ class AuthPolicy(object):
         '''Adds a method to the internal lists of allowed or denied methods. Each object in
         the internal list contains a resource ARN and a condition statement. The condition
         statement can be null.'''
-        if verb != '*' and not hasattr(HttpVerb, verb):
+        if verb not in _VERBS:
             raise NameError('Invalid HTTP verb ' + verb + '. Allowed verbs in HttpVerb class')
-        resourcePattern = re.compile(self.pathRegex)
-        if not resourcePattern.match(resource):
-            raise NameError('Invalid resource path: ' + resource + '. Path should match ' + self.pathRegex)
+        if not AuthPolicy._PATH_RE.match(resource):
+            raise NameError('Invalid resource path: ' + resource + '. Path should match ' + AuthPolicy._PATH_RE.pattern)
 
         if resource[:1] == '/':
             resource = resource[1:]
 
-        resourceArn = 'arn:aws:execute-api:{}:{}:{}/{}/{}/{}'.format(self.region, self.awsAccountId, self.restApiId, self.stage, verb, resource)
+        resourceArn = f'arn:aws:execute-api:{self.region}:{self.awsAccountId}:{self.restApiId}/{self.stage}/{verb}/{resource}'
 
         if effect.lower() == 'allow':
             self.allowMethods.append({
@@ -174,21 +257,21 @@ class AuthPolicy(object):
         '''This function loops over an array of objects containing a resourceArn and
         conditions statement and generates the array of statements for the policy.'''
         statements = []
-
-        if len(methods) > 0:
+        unconditional = []
+
+        for curMethod in methods:
+            if curMethod['conditions']:
+                conditionalStatement = self._getEmptyStatement(effect)
+                conditionalStatement['Resource'] = [curMethod['resourceArn']]
+                conditionalStatement['Condition'] = curMethod['conditions']
+                statements.append(conditionalStatement)
+            else:
+                unconditional.append(curMethod['resourceArn'])
+
+        if unconditional:
             statement = self._getEmptyStatement(effect)
-
-            for curMethod in methods:
-                if curMethod['conditions'] is None or len(curMethod['conditions']) == 0:
-                    statement['Resource'].append(curMethod['resourceArn'])
-                else:
-                    conditionalStatement = self._getEmptyStatement(effect)
-                    conditionalStatement['Resource'].append(curMethod['resourceArn'])
-                    conditionalStatement['Condition'] = curMethod['conditions']
-                    statements.append(conditionalStatement)
-
-            if statement['Resource']:
-                statements.append(statement)
+            statement['Resource'] = unconditional
+            statements.append(statement)
 
         return statements
 
@@ -227,19 +310,16 @@ class AuthPolicy(object):
         conditions. This will generate a policy with two main statements for the effect:
         one statement for Allow and one statement for Deny.
         Methods that includes conditions will have their own statement in the policy.'''
-        if ((self.allowMethods is None or len(self.allowMethods) == 0) and
-                (self.denyMethods is None or len(self.denyMethods) == 0)):
+        if not self.allowMethods and not self.denyMethods:
             raise NameError('No statements defined for the policy')
 
         policy = {
             'principalId': self.principalId,
             'policyDocument': {
                 'Version': self.version,
-                'Statement': []
+                'Statement': (self._getStatementForEffect('Allow', self.allowMethods) +
+                              self._getStatementForEffect('Deny', self.denyMethods))
             }
         }
 
-        policy['policyDocument']['Statement'].extend(self._getStatementForEffect('Allow', self.allowMethods))
-        policy['policyDocument']['Statement'].extend(self._getStatementForEffect('Deny', self.denyMethods))
-
         return policy